@@ -1,11 +1,20 @@
-from flask import Flask, request, Response, jsonify
+from flask import Flask, request, Response, stream_with_context
 import ee
-import urllib.request
+import orjson
+import requests
 import os
 import math
 import json
+import hashlib
 import logging
+import threading
+import time
+from datetime import date
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from cachetools import TTLCache
+from cachetools.func import ttl_cache
 from flask_cors import CORS
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -20,6 +29,60 @@ CORS(app, resources={r"/*": {"origins": "*"}})
 
 # Global flag to track initialization
 ee_initialized = False
+ee_init_lock = threading.Lock()
+
+# Thumbnail formats supported by Earth Engine and their response mimetypes
+IMAGE_FORMATS = {'png': 'image/png', 'jpg': 'image/jpeg'}
+# Larger thumbnails are not offered; the dimensions parameter only shrinks the image
+MAX_DIMENSIONS = 1024
+
+NO_IMAGES_MESSAGE = "No suitable satellite images found for the specified criteria."
+# Earth Engine's error for selecting bands from the band-less placeholder used
+# when neither collection has a scene
+NO_BANDS_ERROR = "was applied to an Image with no bands"
+
+# Sentinel-2 RGB visualization, also applied to rescaled Landsat imagery
+VISUALIZATION_PARAMS = {
+    'bands': ('B4', 'B3', 'B2'),  # RGB bands for natural color
+    'min': 0,
+    'max': 3000,
+    'gamma': 1.4
+}
+
+# Thumbnail options shared by every request; the explicit output projection
+# spares Earth Engine from inferring one
+THUMB_PARAMS_BASE = {'crs': 'EPSG:3857'}
+
+# Coordinates are snapped to 4 decimal places (~11m) and buffers to 3 significant
+# digits (within 0.5%, never zero for small fields) so nearby requests share cache entries
+COORDINATE_DIGITS = 4
+BUFFER_KM_SIGNIFICANT_DIGITS = 3
+GRID_PRECISION = '11m'
+
+# Browser/CDN cache lifetimes: past date ranges select a fixed image, while
+# ranges reaching today may gain new scenes, matching the server-side TTL
+PAST_RANGE_MAX_AGE = 86400
+OPEN_RANGE_MAX_AGE = 3600
+
+# Radius in km of a circle of 1 hectare (0.01 km^2); scales with sqrt(hectares)
+HECTARE_RADIUS_KM = math.sqrt(0.01 / math.pi)
+
+# Downloaded images keyed by (lat, lon, buffer_km, start_date, end_date, dimensions, format).
+# Entries expire after an hour so open-ended date ranges pick up new scenes.
+# Bounded by total bytes rather than entry count, since image sizes vary widely.
+IMAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+image_cache = TTLCache(maxsize=IMAGE_CACHE_MAX_BYTES, ttl=3600, getsizeof=len)
+# Futures for images currently being downloaded, keyed like image_cache, so
+# concurrent identical requests share a single Earth Engine call and download
+inflight_images = {}
+# Guards both image_cache and inflight_images
+image_cache_lock = threading.Lock()
+# How long a coalesced request waits for the in-flight download, in seconds
+INFLIGHT_WAIT_TIMEOUT = 60
+
+# Shared HTTP session so thumbnail downloads reuse pooled keep-alive connections
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
 
 
 def initialize_earth_engine():
@@ -28,9 +91,19 @@ def initialize_earth_engine():
 
     # Skip initialization if already done
     if ee_initialized:
-        logger.info("Earth Engine already initialized")
         return True
 
+    with ee_init_lock:
+        # Another thread may have finished initializing while we waited
+        if ee_initialized:
+            return True
+        return _initialize_earth_engine_locked()
+
+
+def _initialize_earth_engine_locked():
+    """Perform the Earth Engine initialization; must be called with ee_init_lock held."""
+    global ee_initialized
+
     try:
         # Create a service account credentials dictionary from environment variables
         service_account_info = {
@@ -56,7 +129,7 @@ def initialize_earth_engine():
         logger.info("Earth Engine initialized successfully")
         return True
     except Exception as e:
-        logger.error(f"Error initializing Earth Engine: {e}")
+        logger.error("Error initializing Earth Engine: %s", e)
         return False
 
 
@@ -71,12 +144,84 @@ def hectares_to_buffer_km(hectares, safety_margin=1.1):
     Returns:
         float: Buffer distance in kilometers
     """
-    area_sq_km = hectares * 0.01
-    radius_km = math.sqrt(area_sq_km / math.pi)
-    return radius_km * safety_margin
+    return safety_margin * HECTARE_RADIUS_KM * math.sqrt(hectares)
+
+
+@ttl_cache(maxsize=512, ttl=3600)
+def _compute_thumb_url(lat_q, lon_q, buffer_km_q, start_date, end_date, dimensions, image_format):
+    """
+    Build the Earth Engine thumbnail URL for the least cloudy image over the area.
+
+    Results are memoized so identical queries skip the Earth Engine round-trip.
+    The TTL keeps us well within the lifetime of the generated thumbnail URLs.
 
+    Args:
+        lat_q (float): Quantized center latitude in decimal degrees
+        lon_q (float): Quantized center longitude in decimal degrees
+        buffer_km_q (float): Quantized buffer distance in kilometers
+        start_date (str): Start date for image collection (YYYY-MM-DD)
+        end_date (str): End date for image collection (YYYY-MM-DD)
+        dimensions (int): Size of the longest side of the thumbnail in pixels
+        image_format (str): Thumbnail format, one of IMAGE_FORMATS
 
-def get_satellite_image(latitude, longitude, buffer_km=1.8, start_date='2023-01-01', end_date='2025-03-20'):
+    Returns:
+        str: The thumbnail URL
+    """
+    # Create a point and buffer it
+    point = ee.Geometry.Point([lon_q, lat_q])
+    area_of_interest = point.buffer(buffer_km_q * 1000)  # Buffer in meters
+
+    # Get Sentinel-2 imagery
+    sentinel_collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED').filterBounds(area_of_interest).filterDate(
+        start_date, end_date).filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 20)))
+
+    # Get Landsat imagery as a backup
+    landsat_collection = (ee.ImageCollection('LANDSAT/LC08/C02/T1_L2').filterBounds(area_of_interest).filterDate(
+        start_date, end_date))
+
+    # Keep only the least cloudy image of each collection; limit() selects it
+    # server-side without sorting the whole collection
+    sentinel_best = sentinel_collection.limit(1, 'CLOUDY_PIXEL_PERCENTAGE')
+    landsat_best = landsat_collection.limit(1, 'CLOUD_COVER')
+
+    # Rescale Landsat surface reflectance to the Sentinel-2 range and band names
+    landsat_image = landsat_best.first().select(['SR_B4', 'SR_B3', 'SR_B2'], ['B4', 'B3', 'B2'])
+    landsat_image = landsat_image.multiply(0.0000275).add(-0.2).multiply(10000)
+
+    # Prefer Sentinel-2 and fall back to Landsat server-side, so choosing the image
+    # costs no extra round-trip; with neither available the image has no bands
+    image = ee.Image(
+        ee.Algorithms.If(sentinel_best.size().gt(0), sentinel_best.first(),
+                         ee.Algorithms.If(landsat_best.size().gt(0), landsat_image, ee.Image().select([]))))
+
+    # Create the thumbnail in a single Earth Engine call and build its URL locally
+    try:
+        thumb_id = image.visualize(**VISUALIZATION_PARAMS).getThumbId({
+            **THUMB_PARAMS_BASE,
+            'region': area_of_interest,
+            'dimensions': dimensions,
+            'format': image_format
+        })
+    except ee.EEException as e:
+        # Visualizing the band-less placeholder is how an empty result surfaces
+        if NO_BANDS_ERROR not in str(e):
+            raise
+        logger.error(NO_IMAGES_MESSAGE)
+        raise Exception(NO_IMAGES_MESSAGE)
+    map_id = ee.data.makeThumbUrl(thumb_id)
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Generated image URL (truncated): %s...", map_id[:50])
+    return map_id
+
+
+def get_satellite_image(latitude,
+                        longitude,
+                        buffer_km=1.8,
+                        start_date='2023-01-01',
+                        end_date='2025-03-20',
+                        dimensions=1024,
+                        image_format='png'):
     """
     Retrieve a satellite image centered on the given coordinates.
     
@@ -86,64 +231,204 @@ def get_satellite_image(latitude, longitude, buffer_km=1.8, start_date='2023-01-
         buffer_km (float): Buffer distance in kilometers
         start_date (str): Start date for image collection (YYYY-MM-DD)
         end_date (str): End date for image collection (YYYY-MM-DD)
+        dimensions (int): Size of the longest side of the image in pixels
+        image_format (str): Image format, one of IMAGE_FORMATS
         
     Returns:
-        bytes: The satellite image as binary data
+        iterator: The satellite image as chunks of binary data
     """
-    logger.info(f"Retrieving satellite image for coordinates: {latitude}, {longitude} with buffer: {buffer_km}km")
+    logger.info("Retrieving satellite image for coordinates: %s, %s with buffer: %skm", latitude, longitude, buffer_km)
 
-    # Create a point and buffer it
-    point = ee.Geometry.Point([longitude, latitude])
-    area_of_interest = point.buffer(buffer_km * 1000)  # Buffer in meters
+    cache_key = (latitude, longitude, buffer_km, start_date, end_date, dimensions, image_format)
 
-    # Get Sentinel-2 imagery
-    sentinel_collection = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED').filterBounds(area_of_interest).filterDate(
-        start_date, end_date).filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 20)))
+    with image_cache_lock:
+        img_data = image_cache.get(cache_key)
+        future = inflight_images.get(cache_key)
+        is_leader = img_data is None and future is None
+        if is_leader:
+            future = inflight_images[cache_key] = Future()
 
-    # Sort and get the least cloudy image
-    image = sentinel_collection.sort('CLOUDY_PIXEL_PERCENTAGE').first()
+    if img_data is not None:
+        logger.info("Serving satellite image from cache (%d bytes)", len(img_data))
+        return iter((img_data,))
 
-    # If no images found, try Landsat as a backup
-    if image is None:
-        logger.info("No Sentinel-2 images found. Trying Landsat...")
-        landsat_collection = (ee.ImageCollection('LANDSAT/LC08/C02/T1_L2').filterBounds(area_of_interest).filterDate(
-            start_date, end_date))
-        image = landsat_collection.sort('CLOUD_COVER').first()
+    if not is_leader:
+        logger.info("Waiting for in-flight download of the same satellite image")
+        try:
+            img_data = future.result(timeout=INFLIGHT_WAIT_TIMEOUT)
+        except FutureTimeoutError:
+            raise Exception(f"Timed out after {INFLIGHT_WAIT_TIMEOUT}s waiting for an in-flight download "
+                            "of the same satellite image")
+        return iter((img_data,))
 
-        if image is None:
-            logger.error("No suitable satellite images found for the specified criteria.")
-            raise Exception("No suitable satellite images found for the specified criteria.")
+    try:
+        map_id = _compute_thumb_url(*cache_key)
+
+        # Start the download; the body is streamed to the client as it arrives
+        response = http_session.get(map_id, stream=True, timeout=30)
+        if not response.ok:
+            # Earth Engine may only report the band-less placeholder when rendering
+            no_images = response.status_code == 400 and NO_BANDS_ERROR in response.text
+            response.close()
+            if no_images:
+                logger.error(NO_IMAGES_MESSAGE)
+                raise Exception(NO_IMAGES_MESSAGE)
+        response.raise_for_status()
+    except Exception as e:
+        _finish_inflight(cache_key, future, error=e)
+        raise
 
-    # For Sentinel-2, use RGB visualization
-    visualization_params = {
-        'bands': ['B4', 'B3', 'B2'],  # RGB bands for natural color
-        'min': 0,
-        'max': 3000,
-        'gamma': 1.4
-    }
+    logger.info("Streaming satellite image (%s bytes)", response.headers.get('Content-Length', 'unknown'))
 
-    # Get the map URL
-    map_id = image.visualize(**visualization_params).getThumbURL({
-        'region': area_of_interest,
-        'dimensions': '1024',
-        'format': 'png'
-    })
+    # Download on a separate thread so a slow client cannot hold up coalesced requests
+    download = _ImageDownload(response, cache_key, future)
+    threading.Thread(target=download.run, daemon=True).start()
+    return download.stream()
 
-    logger.info(f"Generated image URL (truncated): {map_id[:50]}...")
 
-    # Download and return the image
-    response = urllib.request.urlopen(map_id)
-    img_data = response.read()
+class _ImageDownload:
+    """
+    Download of an upstream image response that clients stream from as it arrives.
 
-    return img_data
+    The finished image is stored in the cache and handed to any requests
+    coalesced onto the same download, independently of how fast the client
+    that started it reads.
+
+    Args:
+        response (requests.Response): Streaming response for the thumbnail URL
+        cache_key (tuple): Key under which to store the downloaded image
+        future (Future): Future shared with coalesced requests
+    """
+
+    def __init__(self, response, cache_key, future):
+        self.response = response
+        self.cache_key = cache_key
+        self.future = future
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def run(self):
+        """Read the whole response into the buffer, then publish the image."""
+        try:
+            for chunk in self.response.iter_content(chunk_size=64 * 1024):
+                with self.condition:
+                    self.chunks.append(chunk)
+                    self.condition.notify_all()
+            _finish_inflight(self.cache_key, self.future, img_data=b''.join(self.chunks))
+        except Exception as e:
+            logger.error("Error downloading satellite image: %s", e)
+            self.error = e
+            _finish_inflight(self.cache_key, self.future, error=e)
+        finally:
+            self.response.close()
+            # Never leave coalesced requests waiting, whatever interrupted us
+            if not self.future.done():
+                self.error = RuntimeError("Satellite image download was interrupted")
+                _finish_inflight(self.cache_key, self.future, error=self.error)
+            with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def stream(self):
+        """
+        Yield the image chunks as they are downloaded.
+
+        Yields:
+            bytes: Chunks of the satellite image
+        """
+        sent = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.done or len(self.chunks) > sent)
+                new_chunks = self.chunks[sent:]
+                finished = self.done
+            sent += len(new_chunks)
+            yield from new_chunks
+            if finished:
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+def _finish_inflight(cache_key, future, img_data=None, error=None):
+    """
+    Resolve an in-flight download, caching the image on success.
+
+    Args:
+        cache_key (tuple): Key of the download in inflight_images and image_cache
+        future (Future): Future shared with coalesced requests
+        img_data (bytes): The downloaded image, if successful
+        error (Exception): The failure, if unsuccessful
+    """
+    with image_cache_lock:
+        # An image larger than the whole cache is served but not kept
+        if error is None and len(img_data) <= IMAGE_CACHE_MAX_BYTES:
+            image_cache[cache_key] = img_data
+        inflight_images.pop(cache_key, None)
+
+    if error is None:
+        future.set_result(img_data)
+    else:
+        future.set_exception(error)
+
+
+def json_response(payload, status):
+    """
+    Serialize a payload to a JSON response.
+
+    Args:
+        payload (dict): JSON-serializable response body
+        status (int): HTTP status code
+
+    Returns:
+        Response: The JSON response
+    """
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
+
+def make_etag(*parts):
+    """
+    Build a strong ETag from the values that determine a response.
+
+    Uses blake2b from hashlib's C implementation, which is stable across
+    processes and workers, unlike the built-in hash().
+
+    Args:
+        *parts: Values identifying the response
+
+    Returns:
+        str: 32-character hex digest
+    """
+    key = '|'.join(str(part) for part in parts)
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def cache_max_age(end_date):
+    """
+    Choose how long clients may cache an image for the given date range.
+
+    Args:
+        end_date (str): End date for image collection (YYYY-MM-DD)
+
+    Returns:
+        int: Max-age in seconds for the Cache-Control header
+    """
+    try:
+        if date.fromisoformat(end_date) < date.today():
+            return PAST_RANGE_MAX_AGE
+    except ValueError:
+        pass
+    return OPEN_RANGE_MAX_AGE
 
 
 @app.route('/satellite', methods=['GET'])
 def satellite_endpoint():
     try:
-        # Initialize Earth Engine (if not already done)
+        # Initialization normally happened at startup; this only retries after a failure
         if not initialize_earth_engine():
-            return jsonify({"error": "Failed to initialize Earth Engine"}), 500
+            return json_response({"error": "Failed to initialize Earth Engine"}, 500)
 
         # Get parameters from the request
         latitude = request.args.get('latitude')
@@ -151,11 +436,14 @@ def satellite_endpoint():
         hectares = request.args.get('hectares', '100')  # Default to 100 hectares if not specified
         start_date = request.args.get('start_date', '2023-01-01')
         end_date = request.args.get('end_date', '2025-03-20')
+        dimensions = request.args.get('dimensions', '1024')
+        # JPEG is smaller but has no alpha, so the area outside the field is black
+        image_format = request.args.get('format', 'png')
 
         # Validate parameters
         if not latitude or not longitude:
             logger.error("Missing required parameters: latitude and longitude")
-            return jsonify({"error": "Latitude and longitude are required parameters"}), 400
+            return json_response({"error": "Latitude and longitude are required parameters"}, 400)
 
         try:
             latitude = float(latitude)
@@ -163,60 +451,107 @@ def satellite_endpoint():
             hectares = float(hectares)
         except ValueError:
             logger.error("Invalid parameter types")
-            return jsonify({"error": "Latitude, longitude, and hectares must be numeric values"}), 400
+            return json_response({"error": "Latitude, longitude, and hectares must be numeric values"}, 400)
+
+        try:
+            dimensions = int(dimensions)
+        except ValueError:
+            dimensions = 0
+        if not 0 < dimensions <= MAX_DIMENSIONS:
+            logger.error("Invalid dimensions parameter")
+            return json_response({"error": f"Dimensions must be an integer between 1 and {MAX_DIMENSIONS}"}, 400)
+
+        if image_format not in IMAGE_FORMATS:
+            logger.error("Invalid format parameter")
+            return json_response({"error": f"Format must be one of: {', '.join(IMAGE_FORMATS)}"}, 400)
 
-        logger.info(f"Processing request for satellite image: lat={latitude}, lon={longitude}, hectares={hectares}")
+        logger.info("Processing request for satellite image: lat=%s, lon=%s, hectares=%s", latitude, longitude,
+                    hectares)
 
         # Convert hectares to buffer distance with 10% safety margin
         buffer_km = hectares_to_buffer_km(hectares, safety_margin=1.1)
 
-        # Get the satellite image as binary data
-        img_data = get_satellite_image(latitude, longitude, buffer_km, start_date, end_date)
-
-        logger.info(f"Successfully generated satellite image ({len(img_data)} bytes)")
+        # Snap inputs to a grid so near-identical queries share cached results
+        lat_q = round(latitude, COORDINATE_DIGITS)
+        lon_q = round(longitude, COORDINATE_DIGITS)
+        buf_q = float(f'{buffer_km:.{BUFFER_KM_SIGNIFICANT_DIGITS}g}')
+
+        # The quantized query deterministically selects the image, so it doubles as the ETag.
+        # Ranges reaching today can gain new scenes, so their ETag rotates with the
+        # cache period and revalidation then fetches the current image.
+        max_age = cache_max_age(end_date)
+        etag_parts = [lat_q, lon_q, buf_q, start_date, end_date, dimensions, image_format]
+        if max_age == OPEN_RANGE_MAX_AGE:
+            etag_parts.append(int(time.time() // OPEN_RANGE_MAX_AGE))
+        etag = make_etag(*etag_parts)
+        cache_headers = {
+            'Cache-Control': f'public, max-age={max_age}',
+            'X-Grid-Precision': GRID_PRECISION
+        }
 
-        # Return the image directly from memory
-        return Response(
-            img_data,
-            mimetype='image/png',
-            headers={'Content-Disposition': f'attachment; filename=satellite_{latitude}_{longitude}_{hectares}ha.png'})
+        if request.if_none_match.contains(etag):
+            logger.info("Client copy of satellite image is current")
+            response = Response(status=304, headers=cache_headers)
+            response.set_etag(etag)
+            return response
+
+        # Get the satellite image as a stream of binary data
+        img_chunks = get_satellite_image(lat_q, lon_q, buf_q, start_date, end_date, dimensions, image_format)
+
+        # Stream the image to the client as it is downloaded
+        filename = f'satellite_{latitude}_{longitude}_{hectares}ha.{image_format}'
+        response = Response(stream_with_context(img_chunks),
+                            mimetype=IMAGE_FORMATS[image_format],
+                            headers={
+                                'Content-Disposition': f'attachment; filename={filename}',
+                                **cache_headers
+                            })
+        response.set_etag(etag)
+        return response
 
     except Exception as e:
-        logger.error(f"Error processing satellite request: {e}")
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error processing satellite request: %s", e)
+        return json_response({"error": str(e)}, 500)
+
+
+# Static response bodies, serialized once at startup
+INDEX_BODY = orjson.dumps({
+    "service": "Satellite Image API",
+    "endpoints": {
+        "/satellite":
+            "Get satellite imagery (params: latitude, longitude, hectares, start_date, end_date, dimensions, format)",
+        "/health": "Health check"
+    },
+    "version": "1.0.0"
+})
+HEALTH_BODY_READY, HEALTH_BODY_PENDING = (orjson.dumps({
+    "status": "ok",
+    "earth_engine_initialized": initialized,
+    "environment": os.getenv("FLASK_ENV", "production")
+}) for initialized in (True, False))
 
 
 @app.route('/health', methods=['GET'])
 def health_check():
     logger.info("Health check requested")
-    return jsonify({
-        "status": "ok",
-        "earth_engine_initialized": ee_initialized,
-        "environment": os.getenv("FLASK_ENV", "production")
-    }), 200
+    body = HEALTH_BODY_READY if ee_initialized else HEALTH_BODY_PENDING
+    return Response(body, status=200, mimetype='application/json')
 
 
 @app.route('/', methods=['GET'])
 def index():
-    return jsonify({
-        "service": "Satellite Image API",
-        "endpoints": {
-            "/satellite": "Get satellite imagery (params: latitude, longitude, hectares, start_date, end_date)",
-            "/health": "Health check"
-        },
-        "version": "1.0.0"
-    }), 200
+    return Response(INDEX_BODY, status=200, mimetype='application/json')
 
 
+# Initialize Earth Engine once per process at startup
+initialize_earth_engine()
+
 # For local development
 if __name__ == '__main__':
-    # Initialize Earth Engine
-    initialize_earth_engine()
-
     # Run the Flask app with parameters from environment variables
     host = os.getenv("FLASK_HOST", "0.0.0.0")
     port = int(os.getenv("FLASK_PORT", 5032))
     debug = os.getenv("FLASK_DEBUG", "0") == "1"
 
-    logger.info(f"Starting Flask app on {host}:{port}, debug={debug}")
+    logger.info("Starting Flask app on %s:%s, debug=%s", host, port, debug)
     app.run(host=host, port=port, debug=debug)
@@ -0,0 +1,10 @@
+import os
+
+# Production server: gunicorn app:app
+# The gevent worker monkey-patches sockets before loading the app, so the
+# Earth Engine calls and thumbnail downloads yield instead of blocking a worker.
+bind = f"{os.getenv('FLASK_HOST', '0.0.0.0')}:{os.getenv('FLASK_PORT', '5032')}"
+worker_class = 'gevent'
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 500))
+timeout = 60